@@ -17,6 +17,8 @@ from utils.downloader import (
     download_urls_from_text,
     download_urls_from_reply,
     handle_convert_to_audio,
+    warm_up_ytdlp,
+    close_http_session,
 )
 
 
@@ -26,6 +28,10 @@ def _load_env() -> None:
         load_dotenv(env_path)
 
 
+async def _post_shutdown(application: Application) -> None:
+    await close_http_session()
+
+
 async def start(update, context: ContextTypes.DEFAULT_TYPE):
     if update and update.message:
         await update.message.reply_text("Bot tải file sẵn sàng. Gửi link hoặc dùng /download, /downloadlist.")
@@ -35,11 +41,12 @@ def main() -> None:
     _load_env()
     setup_logging()
 
-    token = "8438716386:AAGjfQkwVvMCeFtUO9jE44_j5q48tYN0lV4"
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         raise RuntimeError("Missing TELEGRAM_BOT_TOKEN in environment")
 
-    app = Application.builder().token(token).build()
+    app = Application.builder().token(token).post_shutdown(_post_shutdown).build()
+    warm_up_ytdlp()
 
     # Basic
     app.add_handler(CommandHandler("start", start))
@@ -49,17 +56,29 @@ def main() -> None:
     app.add_handler(CommandHandler(["downloadlist", "dllist", "dlall"], download_list))
 
     # Auto-detect links in text or captions
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), download_urls_from_text))
-    app.add_handler(MessageHandler(filters.Caption(True) & filters.Entity("url"), download_urls_from_text))
+    app.add_handler(MessageHandler((filters.TEXT | filters.CAPTION) & (~filters.COMMAND), download_urls_from_text))
 
     # Reply-based downloads
     app.add_handler(CommandHandler("dlreply", download_urls_from_reply))
-    app.add_handler(MessageHandler(filters.REPLY, download_urls_from_reply))
 
     # Callback for audio conversion button
     app.add_handler(CallbackQueryHandler(handle_convert_to_audio, pattern=r"^convert_audio\|"))
 
-    app.run_polling(allowed_updates=["message", "callback_query"]) 
+    allowed_updates = ["message", "callback_query"]
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # Webhook mode lets several replicas share load behind an HTTP load balancer
+        url_path = os.getenv("WEBHOOK_PATH", "telegram")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8080")),
+            url_path=url_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{url_path}",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            allowed_updates=allowed_updates,
+        )
+    else:
+        app.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":
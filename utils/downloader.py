@@ -1,36 +1,81 @@
 import os
 import re
 import asyncio
+import concurrent.futures
+import functools
 import hashlib
+import itertools
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from urllib.parse import urlparse
 import yt_dlp
-import requests
-import subprocess
-import shlex
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import aiofiles
+import aiohttp
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
 from telegram.ext import ContextTypes
 import logging
 
 logger = logging.getLogger(__name__)
 
+class _LRU:
+    """Small bounded LRU mapping; evicts the least recently used entry when full.
+    on_evict(key, value) is called for each evicted entry, e.g. to release resources.
+    """
+
+    def __init__(self, cap: int, on_evict=None):
+        self.d = OrderedDict()
+        self.cap = cap
+        self.on_evict = on_evict
+
+    def get(self, key):
+        if key not in self.d:
+            return None
+        self.d.move_to_end(key)
+        return self.d[key]
+
+    def put(self, key, value) -> None:
+        self.d[key] = value
+        self.d.move_to_end(key)
+        if len(self.d) > self.cap:
+            old_key, old_value = self.d.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key) -> None:
+        self.d.pop(key, None)
+
 # Temporary storage for URLs that are too long for callback data
-_url_cache = {}
+_url_cache = _LRU(int(os.getenv("URL_CACHE_SIZE", "4096")))
 _cache_cleanup_time = 3600  # 1 hour
 
-# Import the new TikTok downloader
-try:
-    from .tiktok_downloader import download_tiktok_with_fallbacks, tiktok_downloader
-    TIKTOK_DOWNLOADER_AVAILABLE = True
-except ImportError:
-    TIKTOK_DOWNLOADER_AVAILABLE = False
-    logger.warning("TikTok downloader not available, falling back to yt-dlp")
-
 # Enhanced TikTok downloader disabled due to httpx version conflict
 ENHANCED_TIKTOK_AVAILABLE = False
 logger.warning("Enhanced TikTok downloader disabled due to httpx version conflict")
 
-# URL patterns for different platforms
+# Dedicated pool for blocking yt-dlp calls; the semaphore caps concurrent downloads
+_YDL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("YDL_WORKERS", "4")),
+    thread_name_prefix="ydl",
+)
+_YDL_SEM = asyncio.Semaphore(int(os.getenv("YDL_CONCURRENCY", "4")))
+# Reusable YoutubeDL instances, cached per worker thread and keyed by option set
+_ydl_local = threading.local()
+_YDL_INSTANCE_CAP = 16
+# Links processed concurrently per /downloadlist command
+LIST_PARALLEL = max(1, int(os.getenv("LIST_PARALLEL", "3")))
+
+# URL pattern sources per platform, fused into _PLATFORM_RE below; the keys also
+# serve as the canonical platform list (e.g. for _PREFIX_LEN)
 PLATFORM_PATTERNS = {
     'facebook': r'(?:https?://)?(?:www\.)?(?:facebook\.com|fb\.com|m\.facebook\.com)',
     'instagram': r'(?:https?://)?(?:www\.)?(?:instagram\.com|instagr\.am)',
@@ -42,6 +87,33 @@ PLATFORM_PATTERNS = {
     'pinterest': r'(?:https?://)?(?:www\.)?(?:pinterest\.com|pin\.it)',
     'qqmusic': r'(?:https?://)?(?:www\.)?(?:y\.qq\.com|i\.y\.qq\.com)',
 }
+# All platforms fused into one regex; the matching named group is the platform
+_PLATFORM_RE = re.compile("|".join(f"(?P<{name}>{pat})" for name, pat in PLATFORM_PATTERNS.items()))
+_URL_RE = re.compile(r'https?://\S+')
+_YT_ID_RE = re.compile(r"(?:v=|/shorts/|/live/|youtu\.be/)([A-Za-z0-9_-]{6,})")
+_QLABEL_RE = re.compile(r"(\d+)")
+_SAFE_TITLE_RE = re.compile(r"[\\/:*?\"<>|]")
+
+# Hostname -> platform; subdomains (m., vm., mobile., ...) resolve via their parent domain
+_HOST_TO_PLATFORM = {
+    'facebook.com': 'facebook',
+    'fb.com': 'facebook',
+    'instagram.com': 'instagram',
+    'instagr.am': 'instagram',
+    'tiktok.com': 'tiktok',
+    'douyin.com': 'douyin',
+    'iesdouyin.com': 'douyin',
+    'youtube.com': 'youtube',
+    'youtu.be': 'youtube',
+    'twitter.com': 'twitter',
+    'x.com': 'twitter',
+    't.co': 'twitter',
+    'reddit.com': 'reddit',
+    'redd.it': 'reddit',
+    'pinterest.com': 'pinterest',
+    'pin.it': 'pinterest',
+    'y.qq.com': 'qqmusic',
+}
 
 # Prefer using Piped API for YouTube if available to avoid cookie challenges
 YOUTUBE_PIPED_ENABLED = os.getenv('YOUTUBE_PIPED_ENABLED', 'true').lower() in ('1', 'true', 'yes')
@@ -50,33 +122,107 @@ PIPED_INSTANCES = [
     'https://piped.mha.fi',
     'https://piped.projectsegfau.lt',
 ]
+# Instances are probed in parallel, so a short per-probe timeout is enough
+PIPED_PROBE_TIMEOUT = 8
+_http_session: aiohttp.ClientSession | None = None
+# Stall timeout for ffmpeg reading remote streams, and a hard cap on a whole merge (seconds)
+FFMPEG_RW_TIMEOUT = 30
+FFMPEG_MERGE_TIMEOUT = int(os.getenv('FFMPEG_MERGE_TIMEOUT', '600'))
+
+# Parallel fragment downloads for HLS/DASH streams. Precedence per platform:
+# YTDLP_CONCURRENT_FRAGMENTS_<PLATFORM> env > YTDLP_CONCURRENT_FRAGMENTS env > built-in default
+_DEFAULT_FRAGMENTS = 8
+_PLATFORM_FRAGMENT_DEFAULTS = {
+    'youtube': 8,
+    'tiktok': 4,
+    'douyin': 4,
+    'facebook': 8,
+    'instagram': 4,
+}
+_FRAGMENTS_ENV = os.getenv('YTDLP_CONCURRENT_FRAGMENTS')
+YTDLP_CONCURRENT_FRAGMENTS = int(_FRAGMENTS_ENV or _DEFAULT_FRAGMENTS)
+PLATFORM_CONCURRENCY = {
+    platform: int(os.getenv(f'YTDLP_CONCURRENT_FRAGMENTS_{platform.upper()}') or _FRAGMENTS_ENV or default)
+    for platform, default in _PLATFORM_FRAGMENT_DEFAULTS.items()
+}
+
+# Network robustness knobs for yt-dlp
+YDL_SOCKET_TIMEOUT = int(os.getenv('YDL_SOCKET_TIMEOUT', '30'))
+YDL_RETRIES = int(os.getenv('YDL_RETRIES', '5'))
+YDL_FRAG_RETRIES = int(os.getenv('YDL_FRAG_RETRIES', '10'))
+YDL_EXTRACTOR_RETRIES = int(os.getenv('YDL_EXTRACTOR_RETRIES', '3'))
 
+@functools.lru_cache(maxsize=1024)
 def detect_platform(url: str) -> str:
     """Detect platform from URL"""
-    for platform, pattern in PLATFORM_PATTERNS.items():
-        if re.search(pattern, url):
-            return platform
-    return 'unknown'
+    try:
+        host = urlparse(url).hostname or ''
+    except ValueError:
+        host = ''
+    if not host:
+        # No scheme/host to parse; fall back to the pattern scan
+        m = _PLATFORM_RE.search(url)
+        return m.lastgroup if m else 'unknown'
+    host = host.removeprefix('www.')
+    # Walk up parent domains so any subdomain depth resolves (e.g. a.b.tiktok.com)
+    while True:
+        platform = _HOST_TO_PLATFORM.get(host)
+        if platform or '.' not in host:
+            return platform or 'unknown'
+        host = host.split('.', 1)[1]
+
+def _first_supported_url(text: str) -> tuple[str, str] | tuple[None, None]:
+    """Return (url, platform) for the first URL in text with a known platform"""
+    return next(
+        ((u, p) for m in _URL_RE.finditer(text) if (p := detect_platform(u := m.group(0))) != 'unknown'),
+        (None, None),
+    )
+
+_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+_MEDIA_ROOT = os.path.join(_BASE_DIR, "data", "media")
+# Checked once at import; restart the bot after adding data/cookies.txt
+_COOKIE_FILE = os.path.join(_BASE_DIR, "data", "cookies.txt")
+_HAS_COOKIES = os.path.exists(_COOKIE_FILE)
+
+# Media directories already created by this process
+_ENSURED_DIRS: set[str] = set()
 
 def get_download_path(platform: str, filename: str) -> str:
     """Get download path based on platform"""
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    media_dir = os.path.join(base_dir, "data", "media", platform)
-    os.makedirs(media_dir, exist_ok=True)
+    media_dir = os.path.join(_MEDIA_ROOT, platform)
+    if media_dir not in _ENSURED_DIRS:
+        os.makedirs(media_dir, exist_ok=True)
+        _ENSURED_DIRS.add(media_dir)
     return os.path.join(media_dir, filename)
 
+def _request_dir(platform: str) -> tempfile.TemporaryDirectory:
+    """Private scratch dir under the platform media dir, removed when the request ends"""
+    return tempfile.TemporaryDirectory(dir=get_download_path(platform, ''), ignore_cleanup_errors=True)
+
+def _first_file(directory: str) -> str | None:
+    with os.scandir(directory) as it:
+        return next((e.path for e in it if e.is_file()), None)
+
 def build_ydl_opts(platform: str, outtmpl: str, audio_only: bool = False) -> dict:
     """Build yt-dlp options per platform, with better reliability for TikTok.
     If data/cookies.txt exists, it will be used automatically.
     """
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     opts = {
         'outtmpl': outtmpl,
         'quiet': True,
         'no_warnings': True,
-        'concurrent_fragment_downloads': 1,
-        'socket_timeout': 24,  # Increased by 20% from 20
-        'retries': 3,
+        'concurrent_fragment_downloads': PLATFORM_CONCURRENCY.get(platform, YTDLP_CONCURRENT_FRAGMENTS),
+        'http_chunk_size': 10 << 20,  # 10 MiB ranged requests for progressive downloads
+        'socket_timeout': YDL_SOCKET_TIMEOUT,
+        'retries': YDL_RETRIES,
+        'fragment_retries': YDL_FRAG_RETRIES,
+        'extractor_retries': YDL_EXTRACTOR_RETRIES,
+        'file_access_retries': 3,
+        # Exponential backoff between retries, capped so one download cannot stall long
+        'retry_sleep_functions': {
+            'http': lambda n: min(30, 2 ** n),
+            'fragment': lambda n: min(15, 2 ** n),
+        },
     }
     if audio_only:
         opts['format'] = 'bestaudio/best'
@@ -93,9 +239,8 @@ def build_ydl_opts(platform: str, outtmpl: str, audio_only: bool = False) -> dic
         opts['merge_output_format'] = 'mp4'
 
     # Optional cookie support
-    cookie_file = os.path.join(base_dir, 'data', 'cookies.txt')
-    if os.path.exists(cookie_file):
-        opts['cookiefile'] = cookie_file
+    if _HAS_COOKIES:
+        opts['cookiefile'] = _COOKIE_FILE
 
     # Platform-specific tweaks (excluding TikTok - now handled separately)
     if platform in ['facebook', 'instagram', 'youtube']:
@@ -109,10 +254,66 @@ def build_ydl_opts(platform: str, outtmpl: str, audio_only: bool = False) -> dic
 
     return opts
 
+def _close_ydl(key: tuple, ydl: yt_dlp.YoutubeDL) -> None:
+    """Release an evicted instance's request handlers and cookie jar"""
+    try:
+        ydl.close()
+    except Exception as e:
+        logger.debug(f"Closing YoutubeDL {key} failed: {e}")
+
+def _get_ydl(key: tuple, opts: dict) -> yt_dlp.YoutubeDL:
+    """Return this thread's cached YoutubeDL for key, retargeted to opts['outtmpl'].
+    Instances are per worker thread, so no locking is needed around downloads.
+    """
+    cache = getattr(_ydl_local, 'cache', None)
+    if cache is None:
+        cache = _ydl_local.cache = _LRU(_YDL_INSTANCE_CAP, on_evict=_close_ydl)
+    ydl = cache.get(key)
+    if ydl is None:
+        # YoutubeDL keeps the dict it is given as its params and rewrites 'outtmpl'
+        # in place, so hand it a copy and keep opts['outtmpl'] a plain string
+        ydl = yt_dlp.YoutubeDL(dict(opts))
+        cache.put(key, ydl)
+    ydl.params['outtmpl'] = {'default': opts['outtmpl']}
+    return ydl
+
+def _ydl_download(key: tuple, opts: dict, url: str) -> str | None:
+    """Download with yt-dlp and return the path of the file it produced.
+    Uses the final filepath reported after post-processing (merge/extract audio).
+    """
+    ydl = _get_ydl(key, opts)
+    info = ydl.extract_info(url, download=True)
+    if not info:
+        return None
+    # Playlists/carousels: use the first downloaded entry
+    if info.get('entries'):
+        info = next((e for e in info['entries'] if e), None)
+        if not info:
+            return None
+    downloads = info.get('requested_downloads') or [{}]
+    return downloads[0].get('filepath') or ydl.prepare_filename(info)
+
+def warm_up_ytdlp() -> None:
+    """Load yt-dlp's extractor registry on the yt-dlp pool so the first download skips the cold start"""
+    def _warm():
+        try:
+            from yt_dlp.extractor import gen_extractor_classes
+            yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
+            gen_extractor_classes()
+        except Exception as e:
+            logger.debug(f"yt-dlp warm-up failed: {e}")
+    _YDL_EXECUTOR.submit(_warm)
+
+async def _run_ydl_download(key: tuple, opts: dict, url: str) -> str | None:
+    """Run _ydl_download on the shared yt-dlp pool, bounded by _YDL_SEM"""
+    async with _YDL_SEM:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(_YDL_EXECUTOR, _ydl_download, key, opts, url)
+
 def _extract_youtube_id(url: str) -> str | None:
     try:
         # Handle various YouTube URL formats
-        m = re.search(r"(?:v=|/shorts/|/live/|youtu\.be/)([A-Za-z0-9_-]{6,})", url)
+        m = _YT_ID_RE.search(url)
         if m:
             return m.group(1)
     except Exception:
@@ -126,132 +327,203 @@ def _select_best_piped_stream(streams: list[dict]) -> dict | None:
         return None
     def parse_quality(s: dict) -> int:
         q = s.get('qualityLabel') or s.get('quality') or ''
-        m = re.search(r"(\d+)", q)
+        m = _QLABEL_RE.search(q)
         return int(m.group(1)) if m else 0
     mp4_streams.sort(key=parse_quality, reverse=True)
     return mp4_streams[0]
 
-def _download_file(url: str, dest_path: str, headers: dict | None = None, timeout: int = 30) -> bool:
+async def _get_http_session() -> aiohttp.ClientSession:
+    """Shared aiohttp session, created lazily on the running event loop"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32),
+            headers={'User-Agent': 'Mozilla/5.0'},
+        )
+    return _http_session
+
+async def close_http_session() -> None:
+    """Close the shared aiohttp session; called once when the bot shuts down"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+async def _download_file(session: aiohttp.ClientSession, url: str, dest_path: str, headers: dict | None = None, timeout: int = 30) -> bool:
     try:
-        with requests.get(url, stream=True, headers=headers or {'User-Agent': 'Mozilla/5.0'}, timeout=timeout) as r:
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        async with session.get(url, headers=headers, timeout=client_timeout) as r:
             r.raise_for_status()
-            with open(dest_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        f.write(chunk)
+            async with aiofiles.open(dest_path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(1 << 20):
+                    await f.write(chunk)
         return True
     except Exception as e:
         logger.error(f"Piped download failed: {e}")
+        # Don't leave a partial file behind for later steps to pick up
+        await _remove_file(dest_path)
         return False
 
-def _download_youtube_via_piped(url: str, platform: str) -> str | None:
-    video_id = _extract_youtube_id(url)
-    if not video_id:
+async def _ffmpeg_merge(video_src: str, audio_src: str, dest_path: str, remote: bool = False) -> bool:
+    """Remux a video and an audio source into dest_path without re-encoding.
+    With remote=True the sources are URLs that ffmpeg fetches itself.
+    """
+    # ffmpeg's http protocol waits forever on a stalled server unless rw_timeout (in µs) is set
+    input_opts = ['-user_agent', 'Mozilla/5.0', '-rw_timeout', str(FFMPEG_RW_TIMEOUT * 1_000_000)] if remote else []
+    proc = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-y',
+            *input_opts, '-i', video_src,
+            *input_opts, '-i', audio_src,
+            '-c', 'copy', '-movflags', '+faststart', dest_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, err = await asyncio.wait_for(proc.communicate(), timeout=FFMPEG_MERGE_TIMEOUT)
+        if proc.returncode == 0 and os.path.exists(dest_path):
+            return True
+        logger.error(f"ffmpeg merge failed: {err.decode(errors='replace')[-500:]}")
+    except asyncio.TimeoutError:
+        logger.error(f"ffmpeg merge timed out after {FFMPEG_MERGE_TIMEOUT}s")
+    except Exception as e:
+        logger.error(f"ffmpeg merge failed: {e}")
+    finally:
+        # Also runs on cancellation, so an abandoned request never leaves ffmpeg running
+        if proc is not None and proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+    try:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+    except Exception:
+        pass
+    return False
+
+async def _probe_piped(session: aiohttp.ClientSession, base: str, video_id: str) -> dict | None:
+    """Fetch the streams listing from one Piped instance, or None if it fails"""
+    try:
+        # Use streams endpoint which exposes separate video/audio URLs
+        api_url = f"{base}/api/v1/streams/{video_id}"
+        async with session.get(api_url, timeout=aiohttp.ClientTimeout(total=PIPED_PROBE_TIMEOUT)) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.json(content_type=None)
+    except Exception as e:
+        logger.info(f"Piped instance failed {base}: {e}")
         return None
-    for base in PIPED_INSTANCES:
+
+async def _download_piped_streams(session: aiohttp.ClientSession, data: dict, video_id: str, out_dir: str) -> str | None:
+    """Download the best streams listed in a Piped response; returns the final mp4 path"""
+    title = data.get('title') or video_id
+    v_streams = data.get('videoStreams') or []
+    a_streams = data.get('audioStreams') or []
+
+    # Try muxed stream first (videoOnly == False)
+    muxed = [s for s in v_streams if not s.get('videoOnly')]
+    def quality_key(s: dict) -> int:
+        q = s.get('qualityLabel') or s.get('quality') or ''
+        m = _QLABEL_RE.search(q)
+        return int(m.group(1)) if m else 0
+    muxed.sort(key=quality_key, reverse=True)
+
+    safe_title = _SAFE_TITLE_RE.sub("_", title)
+    if muxed:
+        dest_path = os.path.join(out_dir, f"{safe_title}.mp4")
+        if await _download_file(session, muxed[0].get('url'), dest_path):
+            return dest_path
+
+    # Fallback: pick best videoOnly + best audio and merge via ffmpeg
+    video_only = [s for s in v_streams if s.get('videoOnly')]
+    video_only.sort(key=quality_key, reverse=True)
+    # Prefer m4a/mp4 audio
+    def audio_rank(a: dict) -> tuple[int, int]:
+        mime = (a.get('mimeType') or '').lower()
+        # prefer m4a/aac, then anything else
+        score = 2 if ('mp4' in mime or 'm4a' in mime or 'aac' in mime) else 1
+        abr = a.get('bitrate') or 0
+        return (score, int(abr))
+    a_streams.sort(key=audio_rank, reverse=True)
+
+    if video_only and a_streams:
+        v = video_only[0]
+        a = a_streams[0]
+        v_path = os.path.join(out_dir, f"{safe_title}.video.mp4")
+        a_ext = '.m4a' if ('m4a' in (a.get('mimeType') or '').lower()) else '.audio'
+        a_path = os.path.join(out_dir, f"{safe_title}{a_ext}")
+        final_path = os.path.join(out_dir, f"{safe_title}.mp4")
+        # Let ffmpeg read both streams over HTTPS and remux directly, skipping temp files
+        if await _ffmpeg_merge(v.get('url'), a.get('url'), final_path, remote=True):
+            return final_path
+        logger.info("ffmpeg remote merge failed, downloading streams first")
+        # Video and audio are independent; fetch them in parallel
+        ok_v, ok_a = await asyncio.gather(
+            _download_file(session, v.get('url'), v_path),
+            _download_file(session, a.get('url'), a_path),
+            return_exceptions=True,
+        )
         try:
-            # Use streams endpoint which exposes separate video/audio URLs
-            api_url = f"{base}/api/v1/streams/{video_id}"
-            resp = requests.get(api_url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=20)
-            if resp.status_code != 200:
-                continue
-            data = resp.json()
-            title = data.get('title') or video_id
-            v_streams = data.get('videoStreams') or []
-            a_streams = data.get('audioStreams') or []
-
-            # Try muxed stream first (videoOnly == False)
-            muxed = [s for s in v_streams if not s.get('videoOnly')]
-            def quality_key(s: dict) -> int:
-                q = s.get('qualityLabel') or s.get('quality') or ''
-                m = re.search(r"(\d+)", q)
-                return int(m.group(1)) if m else 0
-            muxed.sort(key=quality_key, reverse=True)
-
-            out_dir = get_download_path(platform, '')
-            safe_title = re.sub(r"[\\/:*?\"<>|]", "_", title)
-            if muxed:
-                dest_path = os.path.join(out_dir, f"{safe_title}.mp4")
-                if _download_file(muxed[0].get('url'), dest_path):
-                    return dest_path
-
-            # Fallback: pick best videoOnly + best audio and merge via ffmpeg
-            video_only = [s for s in v_streams if s.get('videoOnly')]
-            video_only.sort(key=quality_key, reverse=True)
-            # Prefer m4a/mp4 audio
-            def audio_rank(a: dict) -> tuple[int, int]:
-                mime = (a.get('mimeType') or '').lower()
-                # prefer m4a/aac, then anything else
-                score = 2 if ('mp4' in mime or 'm4a' in mime or 'aac' in mime) else 1
-                abr = a.get('bitrate') or 0
-                return (score, int(abr))
-            a_streams.sort(key=audio_rank, reverse=True)
-
-            if video_only and a_streams:
-                v = video_only[0]
-                a = a_streams[0]
-                v_path = os.path.join(out_dir, f"{safe_title}.video.mp4")
-                a_ext = '.m4a' if ('m4a' in (a.get('mimeType') or '').lower()) else '.audio'
-                a_path = os.path.join(out_dir, f"{safe_title}{a_ext}")
-                final_path = os.path.join(out_dir, f"{safe_title}.mp4")
-                if not _download_file(v.get('url'), v_path):
-                    continue
-                if not _download_file(a.get('url'), a_path):
-                    try:
-                        os.remove(v_path)
-                    except Exception:
-                        pass
-                    continue
+            if ok_v is True and ok_a is True and await _ffmpeg_merge(v_path, a_path, final_path):
+                return final_path
+        finally:
+            for path in (v_path, a_path):
                 try:
-                    cmd = f"ffmpeg -y -i {shlex.quote(v_path)} -i {shlex.quote(a_path)} -c copy {shlex.quote(final_path)}"
-                    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    if proc.returncode == 0 and os.path.exists(final_path):
-                        try:
-                            os.remove(v_path)
-                            os.remove(a_path)
-                        except Exception:
-                            pass
-                        return final_path
-                except Exception as e:
-                    logger.error(f"ffmpeg merge failed: {e}")
-                # cleanup on failure
-                try:
-                    if os.path.exists(v_path):
-                        os.remove(v_path)
-                    if os.path.exists(a_path):
-                        os.remove(a_path)
+                    if os.path.exists(path):
+                        os.remove(path)
                 except Exception:
                     pass
-        except Exception as e:
-            logger.info(f"Piped instance failed {base}: {e}")
-            continue
     return None
 
-def _cleanup_url_cache():
-    """Clean up expired entries from URL cache"""
-    current_time = time.time()
-    expired_keys = [key for key, (_, _, timestamp) in _url_cache.items() \
-                   if current_time - timestamp > _cache_cleanup_time]
-    for key in expired_keys:
-        del _url_cache[key]
+async def _download_youtube_via_piped(url: str, out_dir: str) -> str | None:
+    video_id = _extract_youtube_id(url)
+    if not video_id:
+        return None
+    session = await _get_http_session()
+    # Probe all instances at once and use responses in the order they arrive
+    tasks = [asyncio.create_task(_probe_piped(session, base, video_id)) for base in PIPED_INSTANCES]
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                data = task.result()
+                if not data:
+                    continue
+                try:
+                    path = await _download_piped_streams(session, data, video_id, out_dir)
+                except Exception as e:
+                    logger.info(f"Piped download failed: {e}")
+                    path = None
+                if path:
+                    return path
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
 
 def _store_url_in_cache(url: str, platform: str) -> str:
     """Store URL in cache and return a short hash key"""
-    _cleanup_url_cache()
-    url_hash = hashlib.md5(f"{platform}|{url}".encode()).hexdigest()[:8]
-    _url_cache[url_hash] = (url, platform, time.time())
+    url_hash = hashlib.blake2b(f"{platform}|{url}".encode(), digest_size=4).hexdigest()
+    _url_cache.put(url_hash, (url, platform, time.time()))
     return url_hash
 
 def _get_url_from_cache(url_hash: str) -> tuple:
-    """Get URL and platform from cache by hash"""
-    if url_hash in _url_cache:
-        cached_data = _url_cache[url_hash]
-        if len(cached_data) == 3:
-            url, platform, _ = cached_data
-        else:
-            url, platform = cached_data
-        return url, platform
-    return None, None
+    """Get URL and platform from cache by hash, dropping expired entries"""
+    cached_data = _url_cache.get(url_hash)
+    if cached_data is None:
+        return None, None
+    url, platform, timestamp = cached_data
+    if time.time() - timestamp > _cache_cleanup_time:
+        _url_cache.pop(url_hash)
+        return None, None
+    return url, platform
+
+# Telegram caps callback_data at 64 bytes; precompute the fixed prefix per platform
+_CALLBACK_DATA_LIMIT = 64
+_PREFIX_LEN = {p: len(f"convert_audio|{p}|".encode()) for p in PLATFORM_PATTERNS}
 
 def build_action_keyboard(original_url: str, platform: str) -> InlineKeyboardMarkup:
     buttons = [
@@ -260,8 +532,14 @@ def build_action_keyboard(original_url: str, platform: str) -> InlineKeyboardMar
             InlineKeyboardButton(text="Origin URL", url=original_url),
         ]
     ]
-    callback_data = f"convert_audio|{platform}|{original_url}"
-    if len(callback_data.encode('utf-8')) <= 64:
+    prefix_len = _PREFIX_LEN.get(platform) or len(f"convert_audio|{platform}|".encode())
+    # Character count is a lower bound on UTF-8 length, so long URLs skip the encode;
+    # for ASCII URLs (the common case) it is exact
+    fits = len(original_url) <= _CALLBACK_DATA_LIMIT - prefix_len and (
+        original_url.isascii() or prefix_len + len(original_url.encode('utf-8')) <= _CALLBACK_DATA_LIMIT
+    )
+    if fits:
+        callback_data = f"convert_audio|{platform}|{original_url}"
         buttons.append([
             InlineKeyboardButton(text="Convert to Audio", callback_data=callback_data)
         ])
@@ -272,97 +550,138 @@ def build_action_keyboard(original_url: str, platform: str) -> InlineKeyboardMar
         ])
     return InlineKeyboardMarkup(buttons)
 
-async def send_file_with_buttons(update: Update, platform: str, file_path: str, original_url: str) -> None:
+async def _read_file(file_path: str) -> bytes:
+    """Read a file without blocking the event loop"""
+    async with aiofiles.open(file_path, 'rb') as f:
+        return await f.read()
+
+async def _remove_file(file_path: str) -> None:
+    try:
+        await asyncio.to_thread(os.remove, file_path)
+    except Exception:
+        pass
+
+# Telegram albums accept at most 10 items of a compatible type
+_MEDIA_GROUP_LIMIT = 10
+_INPUT_MEDIA = {
+    'video': InputMediaVideo,
+    'photo': InputMediaPhoto,
+    'audio': InputMediaAudio,
+    'document': InputMediaDocument,
+}
+
+_VIDEO_EXT = {'.mp4', '.avi', '.mov', '.mkv'}
+_IMAGE_EXT = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+_AUDIO_EXT = {'.mp3', '.m4a', '.flac', '.wav', '.aac', '.ogg'}
+_EXT_KIND = {
+    **{e: 'video' for e in _VIDEO_EXT},
+    **{e: 'photo' for e in _IMAGE_EXT},
+    **{e: 'audio' for e in _AUDIO_EXT},
+}
+
+def _media_kind(file_path: str) -> str:
+    return _EXT_KIND.get(os.path.splitext(file_path)[1].lower(), 'document')
+
+async def _send_one(update: Update, file_path: str, keyboard: InlineKeyboardMarkup | None) -> None:
+    """Upload one file with the reply method matching its media type, then delete it"""
     try:
-        keyboard = build_action_keyboard(original_url, platform)
-        filename = os.path.basename(file_path)
-        with open(file_path, 'rb') as f:
-            if filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                await update.message.reply_video(f, reply_markup=keyboard)
-            elif filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
-                await update.message.reply_photo(f, reply_markup=keyboard)
-            elif filename.lower().endswith(('.mp3', '.m4a', '.flac', '.wav', '.aac', '.ogg')):
-                await update.message.reply_audio(f, reply_markup=keyboard)
-            else:
-                await update.message.reply_document(f, reply_markup=keyboard)
+        reply = getattr(update.message, f"reply_{_media_kind(file_path)}")
+        data = await _read_file(file_path)
+        await reply(data, filename=os.path.basename(file_path), reply_markup=keyboard)
     finally:
-        try:
-            os.remove(file_path)
-        except Exception:
-            pass
+        await _remove_file(file_path)
+
+async def send_file_with_buttons(update: Update, platform: str, file_path: str, original_url: str) -> None:
+    await _send_one(update, file_path, build_action_keyboard(original_url, platform))
 
 async def send_files_with_buttons(update: Update, platform: str, file_paths: list[str], original_url: str) -> None:
+    """Send files in input order, packing consecutive files of one media type into albums of up to 10.
+    Albums cannot carry inline keyboards, so when any album is sent the buttons follow once
+    in a separate message instead of being attached to single files.
+    """
     keyboard = build_action_keyboard(original_url, platform)
+    batches: list[tuple[str, list[str]]] = []
+    for kind, group in itertools.groupby(file_paths, key=_media_kind):
+        paths = list(group)
+        batches.extend(
+            (kind, paths[i:i + _MEDIA_GROUP_LIMIT]) for i in range(0, len(paths), _MEDIA_GROUP_LIMIT)
+        )
+    has_album = any(len(batch) > 1 for _, batch in batches)
     try:
-        for file_path in file_paths:
+        for kind, batch in batches:
+            if len(batch) == 1:
+                await _send_one(update, batch[0], None if has_album else keyboard)
+                continue
             try:
-                filename = os.path.basename(file_path)
-                with open(file_path, 'rb') as f:
-                    if filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-                        await update.message.reply_video(f, reply_markup=keyboard)
-                    elif filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
-                        await update.message.reply_photo(f, reply_markup=keyboard)
-                    elif filename.lower().endswith(('.mp3', '.m4a', '.flac', '.wav', '.aac', '.ogg')):
-                        await update.message.reply_audio(f, reply_markup=keyboard)
-                    else:
-                        await update.message.reply_document(f, reply_markup=keyboard)
+                media = [
+                    _INPUT_MEDIA[kind](await _read_file(p), filename=os.path.basename(p))
+                    for p in batch
+                ]
+                await update.message.reply_media_group(media=media)
             finally:
-                try:
-                    os.remove(file_path)
-                except Exception:
-                    pass
+                for p in batch:
+                    await _remove_file(p)
+        if has_album:
+            await update.message.reply_text("Tùy chọn:", reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error sending multiple files: {e}")
 
+async def _send_results(update: Update, platform: str, file_paths: list[str], original_url: str) -> None:
+    if len(file_paths) == 1:
+        await send_file_with_buttons(update, platform, file_paths[0], original_url)
+    else:
+        await send_files_with_buttons(update, platform, file_paths, original_url)
+
+async def _fetch_tiktok(url: str, platform: str, output_dir: str) -> list[str]:
+    """Download a TikTok/Douyin post into output_dir; returns the produced files oldest first"""
+    ydl_opts = {
+        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'format': 'best[ext=mp4]/best[ext=webm]/best[ext=mov]/best[ext=avi]/best[ext=mkv]/best',
+        'writesubtitles': False,
+        'writethumbnail': False,
+        'writeinfojson': False,
+        'writedescription': False,
+        'writeannotations': False,
+        'writeautomaticsub': False,
+        'ignoreerrors': False,
+        'no_warnings': True,
+        'quiet': True
+    }
+    file_path = await _run_ydl_download((platform, 'special'), ydl_opts, url)
+    # The request dir only holds this download, so collect everything it produced
+    # (multi-item posts, photo-mode audio, images) in one scandir pass, oldest first
+    with os.scandir(output_dir) as it:
+        entries = [(e.path, e.stat().st_ctime) for e in it if e.is_file()]
+    files_sorted = [p for p, _ in sorted(entries, key=lambda t: t[1])]
+    if not files_sorted and file_path and os.path.exists(file_path):
+        files_sorted = [file_path]
+    return files_sorted
+
+async def _fetch_direct(url: str, platform: str, output_dir: str) -> list[str]:
+    """Download url into output_dir via Piped (YouTube) or yt-dlp; returns the produced file"""
+    # Prefer Piped for YouTube if enabled
+    if platform == 'youtube' and YOUTUBE_PIPED_ENABLED:
+        path = await _download_youtube_via_piped(url, output_dir)
+        if path and os.path.exists(path):
+            return [path]
+
+    ydl_opts = build_ydl_opts(platform, os.path.join(output_dir, '%(title)s.%(ext)s'))
+    file_path = await _run_ydl_download((platform, False), ydl_opts, url)
+    if not (file_path and os.path.exists(file_path)):
+        file_path = _first_file(output_dir)
+    return [file_path] if file_path else []
+
+def _fetcher(platform: str):
+    return _fetch_tiktok if platform in ['tiktok', 'douyin'] else _fetch_direct
+
 async def download_tiktok_special(url: str, platform: str, update: Update) -> bool:
     try:
-        output_dir = get_download_path(platform, "")
-        if TIKTOK_DOWNLOADER_AVAILABLE:
-            try:
-                success, method, result = await download_tiktok_with_fallbacks(url, output_dir)
-                if success and os.path.exists(result):
-                    all_files = [os.path.join(output_dir, f) for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f))]
-                    video_files = [f for f in all_files if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm'))]
-                    if video_files:
-                        files_sorted = sorted(video_files, key=lambda p: os.path.getctime(p), reverse=False)
-                        if len(files_sorted) == 1:
-                            await send_file_with_buttons(update, platform, files_sorted[0], url)
-                        else:
-                            await send_files_with_buttons(update, platform, files_sorted, url)
-                        return True
-            except Exception as e:
-                logger.error(f"Custom TikTok downloader error: {e}")
-        logger.info("Using yt-dlp fallback with video-only options")
-        try:
-            ydl_opts = {
-                'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-                'format': 'best[ext=mp4]/best[ext=webm]/best[ext=mov]/best[ext=avi]/best[ext=mkv]/best',
-                'writesubtitles': False,
-                'writethumbnail': False,
-                'writeinfojson': False,
-                'writedescription': False,
-                'writeannotations': False,
-                'writeautomaticsub': False,
-                'ignoreerrors': False,
-                'no_warnings': True,
-                'quiet': True
-            }
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(ydl_opts).download([url]))
-            if result == 0:
-                video_files = [f for f in os.listdir(output_dir) if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm'))]
-                if video_files:
-                    latest_video = max(video_files, key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
-                    file_path = os.path.join(output_dir, latest_video)
-                    await send_file_with_buttons(update, platform, file_path, url)
-                    return True
-                else:
-                    return False
-            else:
+        with _request_dir(platform) as output_dir:
+            files = await _fetch_tiktok(url, platform, output_dir)
+            if not files:
                 return False
-        except Exception as e:
-            logger.error(f"yt-dlp fallback error: {e}")
-            return False
+            await _send_results(update, platform, files, url)
+            return True
     except Exception as e:
         logger.error(f"TikTok special download error: {e}")
         return False
@@ -373,44 +692,24 @@ async def download_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         url = update.message.reply_to_message.text or update.message.reply_to_message.caption or ""
     if not url:
         return
-    url_pattern = r'https?://[^\s]+'
-    urls = re.findall(url_pattern, url)
-    if not urls:
-        return
-    platform = detect_platform(urls[0])
-    if platform == 'unknown':
+    url, platform = _first_supported_url(url)
+    if not url:
         return
     if platform in ['tiktok', 'douyin']:
-        success = await download_tiktok_special(urls[0], platform, update)
+        success = await download_tiktok_special(url, platform, update)
     else:
-        success = await download_direct(urls[0], platform, update)
+        success = await download_direct(url, platform, update)
     if not success:
         pass
 
 async def download_direct(url: str, platform: str, update: Update) -> bool:
     try:
-        # Prefer Piped for YouTube if enabled
-        if platform == 'youtube' and YOUTUBE_PIPED_ENABLED:
-            path = _download_youtube_via_piped(url, platform)
-            if path and os.path.exists(path):
-                await send_file_with_buttons(update, platform, path, url)
-                return True
-
-        ydl_opts = build_ydl_opts(platform, get_download_path(platform, '%(title)s.%(ext)s'))
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(ydl_opts).download([url]))
-        if result == 0:
-            media_dir = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")), "data", "media", platform)
-            files = [f for f in os.listdir(media_dir) if os.path.isfile(os.path.join(media_dir, f))]
-            if files:
-                latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(media_dir, x)))
-                file_path = os.path.join(media_dir, latest_file)
-                await send_file_with_buttons(update, platform, file_path, url)
-                return True
-            else:
-                return True
-        else:
-            return False
+        with _request_dir(platform) as tmp:
+            files = await _fetch_direct(url, platform, tmp)
+            if not files:
+                return False
+            await _send_results(update, platform, files, url)
+            return True
     except Exception as e:
         logger.error(f"Error in direct download: {e}")
         return False
@@ -419,14 +718,8 @@ async def download_urls_from_text(update: Update, context: ContextTypes.DEFAULT_
     text = update.message.text or update.message.caption or ""
     if not text:
         return
-    url_pattern = r'https?://[^\s]+'
-    urls = re.findall(url_pattern, text)
-    if not urls:
-        return
-    supported_urls = [url for url in urls if detect_platform(url) != 'unknown']
-    if supported_urls:
-        url = supported_urls[0]
-        platform = detect_platform(url)
+    url, platform = _first_supported_url(text)
+    if url:
         if platform in ['tiktok', 'douyin']:
             success = await download_tiktok_special(url, platform, update)
         else:
@@ -434,26 +727,54 @@ async def download_urls_from_text(update: Update, context: ContextTypes.DEFAULT_
         if not success:
             pass
 
+async def _dispatch(url: str, platform: str, update: Update, prev_sent: asyncio.Event | None, sent: asyncio.Event) -> bool:
+    """Download url concurrently with its neighbours, but send only after the previous link has been sent"""
+    try:
+        with _request_dir(platform) as output_dir:
+            try:
+                files = await _fetcher(platform)(url, platform, output_dir)
+            except Exception as e:
+                logger.error(f"List download error for {url}: {e}")
+                files = []
+            if prev_sent is not None:
+                await prev_sent.wait()
+            if not files:
+                return False
+            await _send_results(update, platform, files, url)
+            return True
+    except Exception as e:
+        logger.error(f"List send error for {url}: {e}")
+        return False
+    finally:
+        sent.set()
+
 async def download_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = " ".join(context.args).strip()
     if not text and update.message and update.message.reply_to_message:
         text = (update.message.reply_to_message.text or update.message.reply_to_message.caption or "").strip()
     if not text:
         return
-    urls = re.findall(r'https?://[^\s]+', text)
+    urls = _URL_RE.findall(text)
     if not urls:
         return
+    seen = set()
+    tasks = []
     for url in urls:
-        platform = detect_platform(url)
-        try:
-            if platform in ['tiktok', 'douyin']:
-                ok = await download_tiktok_special(url, platform, update)
-            elif platform != 'unknown':
-                ok = await download_direct(url, platform, update)
-            else:
-                ok = False
-        except Exception:
-            pass
+        if url in seen:
+            continue
+        seen.add(url)
+        if (platform := detect_platform(url)) != 'unknown':
+            tasks.append((url, platform))
+    # Download up to LIST_PARALLEL links at once (_YDL_SEM still bounds yt-dlp globally);
+    # each link waits for the previous one's send, so replies arrive in input order
+    prev_sent = None
+    for i in range(0, len(tasks), LIST_PARALLEL):
+        coros = []
+        for url, platform in tasks[i:i + LIST_PARALLEL]:
+            sent = asyncio.Event()
+            coros.append(_dispatch(url, platform, update, prev_sent, sent))
+            prev_sent = sent
+        await asyncio.gather(*coros)
 
 async def handle_convert_to_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -478,25 +799,19 @@ async def handle_convert_to_audio(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_reply_markup(reply_markup=None)
         return
     try:
-        outtmpl = get_download_path(platform or 'youtube', '%(title)s.%(ext)s')
-        ydl_opts = build_ydl_opts(platform or 'youtube', outtmpl, audio_only=True)
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, lambda: yt_dlp.YoutubeDL(ydl_opts).download([original_url]))
-        if result == 0:
-            media_dir = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")), "data", "media", platform or 'youtube')
-            files = [f for f in os.listdir(media_dir) if os.path.isfile(os.path.join(media_dir, f))]
-            if files:
-                latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(media_dir, x)))
-                file_path = os.path.join(media_dir, latest_file)
+        with _request_dir(platform or 'youtube') as tmp:
+            outtmpl = os.path.join(tmp, '%(title)s.%(ext)s')
+            ydl_opts = build_ydl_opts(platform or 'youtube', outtmpl, audio_only=True)
+            file_path = await _run_ydl_download((platform or 'youtube', True), ydl_opts, original_url)
+            if not (file_path and os.path.exists(file_path)):
+                file_path = _first_file(tmp)
+            if file_path:
                 try:
                     keyboard = build_action_keyboard(original_url, platform)
-                    with open(file_path, 'rb') as f:
-                        await query.message.reply_audio(f, reply_markup=keyboard)
+                    data = await _read_file(file_path)
+                    await query.message.reply_audio(data, filename=os.path.basename(file_path), reply_markup=keyboard)
                 finally:
-                    try:
-                        os.remove(file_path)
-                    except Exception:
-                        pass
+                    await _remove_file(file_path)
     except Exception as e:
         logger.error(f"Convert to audio error: {e}")
 
@@ -506,17 +821,8 @@ async def download_urls_from_reply(update: Update, context: ContextTypes.DEFAULT
     text = update.message.reply_to_message.text or update.message.reply_to_message.caption or ""
     if not text:
         return
-    urls = re.findall(r'https?://[^\s]+', text)
-    if not urls:
-        return
-    supported_urls = []
-    for url in urls:
-        platform = detect_platform(url)
-        if platform != 'unknown':
-            supported_urls.append(url)
-    if supported_urls:
-        url = supported_urls[0]
-        platform = detect_platform(url)
+    url, platform = _first_supported_url(text)
+    if url:
         if platform in ['tiktok', 'douyin']:
             success = await download_tiktok_special(url, platform, update)
         else: